@@ -1,35 +1,56 @@
-
+import os
+import selectors
 import socket
+import stat
 import threading
 import sys
 
-HOST = "127.0.0.1"  
+HOST = "127.0.0.1"
 PORT = 5000
+QUIT_WAIT = 2.0     # seconds to wait for the server's last lines after /quit
+
+
+def echo_lines(buf: bytearray) -> None:
+    """Write every complete line in buf to stdout as raw UTF-8, keep the unfinished tail."""
+    nl = buf.rfind(b"\n")
+    if nl < 0:
+        return
+    out = sys.stdout.buffer
+    out.write(buf[:nl + 1])
+    out.flush()
+    del buf[:nl + 1]
 
 
 def recv_loop(sock: socket.socket) -> None:
-    f = sock.makefile("r", encoding="utf-8", newline="\n")
+    buf = bytearray()   # grows in place; bytes += bytes would copy everything each chunk
     try:
         while True:
-            line = f.readline()
-            if not line:
+            chunk = sock.recv(65536)
+            if not chunk:
                 print("\n[Disconnected from server]")
                 break
-            print(line.rstrip("\n"))
+            buf += chunk
+            if b"\n" in chunk:
+                echo_lines(buf)
     except Exception:
         pass
-    finally:
-        try:
-            f.close()
-        except Exception:
-            pass
 
 
-def main() -> None:
-    print(f"Connecting to {HOST}:{PORT} ...")
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    sock.connect((HOST, PORT))
+def can_poll_stdin() -> bool:
+    """True if stdin can go into a selector next to the socket.
 
+    Windows select() only takes sockets, and epoll rejects regular files
+    and /dev/null, so a redirected script has to use thread_loop().
+    """
+    if sys.platform == "win32":
+        return False
+    fd = sys.stdin.fileno()
+    mode = os.fstat(fd).st_mode
+    return os.isatty(fd) or stat.S_ISFIFO(mode) or stat.S_ISSOCK(mode)
+
+
+def thread_loop(sock: socket.socket) -> None:
+    """Read the socket on its own thread while input() blocks on this one."""
     t = threading.Thread(target=recv_loop, args=(sock,), daemon=True)
     t.start()
 
@@ -39,7 +60,78 @@ def main() -> None:
             sock.sendall((user_input + "\n").encode("utf-8"))
             if user_input.strip().lower() == "/quit":
                 break
-    except (KeyboardInterrupt, EOFError):
+    except EOFError:
+        sock.sendall(b"/quit\n")
+
+    # let the reader print the server's last lines before the socket is closed
+    t.join(QUIT_WAIT)
+
+
+def select_loop(sock: socket.socket) -> None:
+    """Wait on the socket and stdin together from a single thread."""
+    stdin_fd = sys.stdin.fileno()
+    sel = selectors.DefaultSelector()
+    sel.register(sock, selectors.EVENT_READ, "sock")
+    sel.register(stdin_fd, selectors.EVENT_READ, "stdin")
+
+    # both grow in place; bytes += bytes would copy everything each chunk
+    buf = bytearray()       # from the server
+    typed = bytearray()     # from the keyboard, not yet a full line
+    quitting = False
+    while True:
+        events = sel.select(QUIT_WAIT if quitting else None)
+        if not events:
+            # sent /quit but the server never closed the connection
+            return
+        for key, _ in events:
+            if key.data == "sock":
+                chunk = sock.recv(65536)
+                if not chunk:
+                    print("\n[Disconnected from server]")
+                    return
+                buf += chunk
+                # only look for a line end in the new chunk, not the whole buffer again
+                if b"\n" in chunk:
+                    echo_lines(buf)
+                continue
+
+            # read stdin's fd directly, a buffered readline() could hide lines from select()
+            data = os.read(stdin_fd, 65536)
+            if not data:
+                # end of input leaves the chat the same way /quit does
+                sock.sendall(b"/quit\n")
+                sel.unregister(stdin_fd)
+                quitting = True
+                break
+            typed += data
+            if b"\n" not in data:
+                continue
+            nl = typed.rfind(b"\n")
+            lines = bytes(typed[:nl + 1])
+            del typed[:nl + 1]
+            sock.sendall(lines)
+            if any(line.strip().lower() == b"/quit" for line in lines.split(b"\n")):
+                # stop reading stdin, but keep printing until the server hangs up
+                sel.unregister(stdin_fd)
+                quitting = True
+                break
+
+
+def main() -> None:
+    print(f"Connecting to {HOST}:{PORT} ...")
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    # send every line right away instead of waiting on Nagle
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1 << 20)
+    sock.connect((HOST, PORT))
+    sys.stdout.flush()  # server lines go straight to sys.stdout.buffer from here on
+
+    try:
+        if can_poll_stdin():
+            select_loop(sock)
+        else:
+            thread_loop(sock)
+    except KeyboardInterrupt:
         try:
             sock.sendall(b"/quit\n")
         except Exception:
@@ -49,7 +141,6 @@ def main() -> None:
             sock.close()
         except Exception:
             pass
-        sys.exit(0)
 
 
 if __name__ == "__main__":
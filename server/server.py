@@ -1,22 +1,131 @@
+import logging
+import selectors
 import socket
-import threading
+import sys
+import time
 
 HOST = "0.0.0.0"
 PORT = 5000
-
-clients_lock = threading.Lock()
+SOCK_BUF_SIZE = 1 << 20   # SO_SNDBUF / SO_RCVBUF, inherited by accepted connections
+RECV_BUF_SIZE = 1 << 16   # per-connection read buffer, grows only for longer lines
+MAX_LINE = 1 << 20        # longest line a client may send, the read buffer never grows past it
+MAX_CONNECTIONS = 500     # stays under the 512-socket select() limit on Windows
+MAX_PENDING_OUT = 1 << 22 # queued output per connection before it counts as not reading
+ACCEPT_RETRY_DELAY = 1.0  # seconds the listener sits out after accept() fails
+
+log = logging.getLogger("server")
+sel = selectors.DefaultSelector()
 clients = {}          # username -> socket
 pairs = {}            # username -> partner_username
+dirty = set()         # sockets with output queued since the last flush_all()
+paused = {}           # listening socket -> time.monotonic() when accept() may be retried
+
+# protocol lines are encoded once here instead of on every send
+_NL = b"\n"
+_WELCOME = b"[SERVER] Welcome! Enter your username:\n"
+_BANNER = (
+    b"[SERVER] Hello %s!\n"
+    b"[SERVER] Commands:\n"
+    b"  /users                -> list online users\n"
+    b"  /chat <username>      -> start chat with user\n"
+    b"  /leave                -> leave current chat\n"
+    b"  /quit                 -> disconnect\n"
+    b"[SERVER] Tip: after /chat, just type messages normally.\n"
+)
+_BUSY = b"[SERVER] Server busy. Try again later.\n"
+_BYE = b"[SERVER] Bye.\n"
+_ERR_EMPTY_NAME = b"[SERVER] Empty username. Bye.\n"
+_ERR_NAME_TAKEN = b"[SERVER] Username already taken. Bye.\n"
+_ERR_NOT_IN_CHAT = b"[SERVER] You're not in a chat. Use /users then /chat <username>.\n"
+_ERR_LEAVE_NO_CHAT = b"[SERVER] You're not in a chat.\n"
+_ERR_UNKNOWN = b"[SERVER] Unknown command.\n"
+_ERR_LINE_TOO_LONG = b"[SERVER] Line too long, it was not sent.\n"
+_ERR_CHAT_USAGE = b"[SERVER] Usage: /chat <username>\n"
+_ERR_CHAT_SELF = b"[SERVER] You can't chat with yourself.\n"
+_ERR_PARTNER_GONE = b"[SERVER] Partner disconnected. Chat closed.\n"
+_USERS_PREFIX = b"[SERVER] Online: "
+_NO_USERS = b"[SERVER] No other users online.\n"
+_NOT_FOUND = b"[SERVER] User '%s' not found.\n"
+_BUSY_CHATTING = b"[SERVER] '%s' is already chatting with '%s'.\n"
+_CHAT_STARTED = b"[SERVER] Chat started with %s.\n"
+_CHAT_INVITED = b"[SERVER] %s started a chat with you. You are now connected.\n"
+_LEFT_PREVIOUS = b"[SERVER] Left previous chat with %s.\n"
+_YOU_LEFT = b"[SERVER] You left the chat with %s.\n"
+_PARTNER_LEFT = b"[SERVER] %s left the chat.\n"
+_PARTNER_DISCONNECTED = b"[SERVER] %s disconnected. Chat closed.\n"
+
+
+def flush(sock: socket.socket, state: dict) -> None:
+    """Send as much pending output as the socket accepts right now."""
+    out = state["out"]
+    try:
+        while out:
+            n = sock.send(out)
+            del out[:n]
+    except BlockingIOError:
+        pass
+    except OSError:
+        # peer is gone, the read side will notice and clean up
+        out.clear()
+
+    # still this far behind after the kernel took all it could: the peer is not
+    # keeping up, drop it rather than buffer for it forever
+    if len(out) > MAX_PENDING_OUT or state["overflow"]:
+        log.info("Dropping %s: too much unread output", state["username"] or sock)
+        out.clear()
+        close_client(sock, state)
+        return
+
+    # only ask for EVENT_WRITE while there is something left to send
+    events = selectors.EVENT_READ | (selectors.EVENT_WRITE if out else 0)
+    sel.modify(sock, events, state)
+
+
+def flush_all() -> None:
+    """Flush every socket written to during this loop iteration, once each."""
+    while dirty:
+        sock = dirty.pop()
+        try:
+            flush(sock, sel.get_key(sock).data)
+        except Exception:
+            pass
 
 
-def send_line(sock: socket.socket, text: str) -> None:
+def send_bytes(sock: socket.socket, *parts: bytes) -> None:
+    """Queue already-encoded fragments for sock, without joining them first."""
     try:
-        sock.sendall((text + "\n").encode("utf-8"))
+        state = sel.get_key(sock).data
+        out = state["out"]
+        if len(out) > MAX_PENDING_OUT:
+            # stop queuing and let the next flush() drop the connection,
+            # rather than silently skipping lines it was meant to get
+            state["overflow"] = True
+            dirty.add(sock)
+            return
+        for part in parts:
+            out += part
+        dirty.add(sock)
     except Exception:
         pass
 
 
+def tune_socket(sock: socket.socket) -> None:
+    """Set on the listener before listen(): accepted sockets inherit these, and
+    SO_RCVBUF only affects the TCP window scale if it is set before the handshake."""
+    # chat lines are tiny and we already batch our own writes, so Nagle only adds delay
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCK_BUF_SIZE)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCK_BUF_SIZE)
+
+
 def safe_close(sock: socket.socket) -> None:
+    dirty.discard(sock)
+    try:
+        key = sel.unregister(sock)
+        # last chance for farewell lines like "Bye." to go out
+        sock.send(key.data["out"])
+    except Exception:
+        pass
     try:
         sock.shutdown(socket.SHUT_RDWR)
     except Exception:
@@ -29,203 +138,351 @@ def safe_close(sock: socket.socket) -> None:
 
 def cleanup_user(username: str) -> None:
     """Remove user from clients, and disconnect pairing safely."""
-    with clients_lock:
-        sock = clients.pop(username, None)
-        partner = pairs.pop(username, None)
-
-        # If the user had a partner, break the pairing on the other side too
-        if partner is not None and pairs.get(partner) == username:
-            pairs.pop(partner, None)
-            partner_sock = clients.get(partner)
-        else:
-            partner_sock = None
+    sock = clients.pop(username, None)
+    partner = pairs.pop(username, None)
+
+    # If the user had a partner, break the pairing on the other side too
+    if partner is not None and pairs.get(partner) == username:
+        pairs.pop(partner, None)
+        partner_sock = clients.get(partner)
+    else:
+        partner_sock = None
 
     if partner_sock:
-        send_line(partner_sock, f"[SERVER] {username} disconnected. Chat closed.")
+        send_bytes(partner_sock, _PARTNER_DISCONNECTED % username.encode("utf-8"))
     if sock:
         safe_close(sock)
 
 
 def set_pair(a: str, b: str) -> None:
-    with clients_lock:
-        pairs[a] = b
-        pairs[b] = a
+    pairs[a] = b
+    pairs[b] = a
 
 
 def get_partner(username: str) -> str | None:
-    with clients_lock:
-        return pairs.get(username)
+    return pairs.get(username)
 
 
 def get_socket(username: str) -> socket.socket | None:
-    with clients_lock:
-        return clients.get(username)
+    return clients.get(username)
+
+
+def lookup_forward(username: str) -> tuple[str | None, socket.socket | None]:
+    """Partner name and partner socket for username, in one call."""
+    partner = pairs.get(username)
+    return partner, (clients.get(partner) if partner else None)
 
 
 def list_users(except_name: str) -> list[str]:
-    with clients_lock:
-        return sorted([u for u in clients.keys() if u != except_name])
+    return sorted([u for u in clients.keys() if u != except_name])
+
+
+def register_user(conn: socket.socket, state: dict, username: str) -> bool:
+    """Handle the first line of a connection. Returns False to disconnect."""
+    if not username:
+        send_bytes(conn, _ERR_EMPTY_NAME)
+        return False
+
+    if username in clients:
+        send_bytes(conn, _ERR_NAME_TAKEN)
+        return False
+
+    clients[username] = conn
+    state["username"] = username
+    state["prefix"] = (username + ": ").encode("utf-8")
+
+    send_bytes(conn, _BANNER % username.encode("utf-8"))
+    return True
+
+
+def cmd_users(conn: socket.socket, username: str, arg: bytes) -> bool:
+    users = list_users(username)
+    if users:
+        send_bytes(conn, _USERS_PREFIX, ", ".join(users).encode("utf-8"), _NL)
+    else:
+        send_bytes(conn, _NO_USERS)
+    return True
+
+
+def cmd_chat(conn: socket.socket, username: str, arg: bytes) -> bool:
+    target = arg.strip().decode("utf-8", "replace")
+    if not target:
+        send_bytes(conn, _ERR_CHAT_USAGE)
+        return True
+
+    if target == username:
+        send_bytes(conn, _ERR_CHAT_SELF)
+        return True
+
+    target_sock = get_socket(target)
+    if not target_sock:
+        send_bytes(conn, _NOT_FOUND % target.encode("utf-8"))
+        return True
+
+    # Close previous chat if exists
+    old_partner = get_partner(username)
+    if old_partner:
+        if pairs.get(old_partner) == username:
+            pairs.pop(old_partner, None)
+        pairs.pop(username, None)
+
+        old_partner_sock = get_socket(old_partner)
+        if old_partner_sock:
+            send_bytes(old_partner_sock, _PARTNER_LEFT % username.encode("utf-8"))
+        send_bytes(conn, _LEFT_PREVIOUS % old_partner.encode("utf-8"))
+
+    # If target is already in chat, we can choose to refuse
+    target_partner = get_partner(target)
+    if target_partner and target_partner != username:
+        send_bytes(conn, _BUSY_CHATTING % (target.encode("utf-8"), target_partner.encode("utf-8")))
+        return True
+
+    set_pair(username, target)
+    send_bytes(conn, _CHAT_STARTED % target.encode("utf-8"))
+    send_bytes(target_sock, _CHAT_INVITED % username.encode("utf-8"))
+    return True
+
+
+def cmd_leave(conn: socket.socket, username: str, arg: bytes) -> bool:
+    partner = get_partner(username)
+    if not partner:
+        send_bytes(conn, _ERR_LEAVE_NO_CHAT)
+        return True
+
+    if pairs.get(partner) == username:
+        pairs.pop(partner, None)
+    pairs.pop(username, None)
+
+    partner_sock = get_socket(partner)
+    if partner_sock:
+        send_bytes(partner_sock, _PARTNER_LEFT % username.encode("utf-8"))
+    send_bytes(conn, _YOU_LEFT % partner.encode("utf-8"))
+    return True
+
+
+def cmd_quit(conn: socket.socket, username: str, arg: bytes) -> bool:
+    send_bytes(conn, _BYE)
+    return False
+
+
+# command token (lowercase bytes) -> handler(conn, username, arg); False means disconnect
+COMMANDS = {
+    b"/users": cmd_users,
+    b"/chat": cmd_chat,
+    b"/leave": cmd_leave,
+    b"/quit": cmd_quit,
+}
+
+
+def handle_command(conn: socket.socket, username: str, line: bytes) -> bool:
+    """Run a /command. Returns False to disconnect."""
+    # split on any whitespace like the text protocol always did, so "/users\r"
+    # from CRLF clients and "/chat\tbob" still work
+    parts = line.split(None, 1)
+    arg = parts[1] if len(parts) > 1 else b""
+
+    handler = COMMANDS.get(parts[0].lower())
+    if handler is None:
+        send_bytes(conn, _ERR_UNKNOWN)
+        return True
+    return handler(conn, username, arg)
+
+
+def handle_line(conn: socket.socket, state: dict, line: bytes) -> bool:
+    """Process one complete line from a client. Returns False to disconnect."""
+    username = state["username"]
+    if username is None:
+        return register_user(conn, state, line.decode("utf-8", "replace").strip())
+
+    if not line:
+        return True
+
+    if line[:1] != b"/":
+        # fast path: a normal message to an existing partner skips command parsing
+        partner, partner_sock = lookup_forward(username)
+        if partner_sock is not None:
+            # forward the raw bytes, no decode / re-encode needed
+            send_bytes(partner_sock, state["prefix"], line, _NL)
+            return True
+
+        if not partner:
+            send_bytes(conn, _ERR_NOT_IN_CHAT)
+        else:
+            # partner disappeared
+            pairs.pop(username, None)
+            send_bytes(conn, _ERR_PARTNER_GONE)
+        return True
+
+    return handle_command(conn, username, line)
+
+
+def close_client(conn: socket.socket, state: dict) -> None:
+    if state["username"]:
+        cleanup_user(state["username"])
+    else:
+        safe_close(conn)
+
+
+def read_ready(conn: socket.socket, state: dict) -> None:
+    rbuf = state["rbuf"]
+    rpos = state["rpos"]
+    if rpos == len(rbuf):
+        if rpos >= MAX_LINE:
+            # refuse the line and throw away the rest of it as it arrives
+            send_bytes(conn, _ERR_LINE_TOO_LONG)
+            state["skip"] = True
+            rpos = 0
+        else:
+            # a single line longer than the whole buffer, make room for it
+            rbuf.extend(bytes(len(rbuf)))
 
+    try:
+        with memoryview(rbuf) as view:
+            n = conn.recv_into(view[rpos:])
+    except BlockingIOError:
+        return
+    except OSError:
+        n = 0
+
+    if not n:
+        # client disconnected
+        close_client(conn, state)
+        return
+
+    end = rpos + n
+    if state["skip"]:
+        # still inside a refused line (rpos is 0 here), drop it up to its newline
+        nl = rbuf.find(b"\n", 0, end)
+        if nl < 0:
+            state["rpos"] = 0
+            return
+        state["skip"] = False
+        rbuf[:end - nl - 1] = rbuf[nl + 1:end]
+        rpos, end = 0, end - nl - 1
 
-def handle_client(conn: socket.socket, addr) -> None:
-    username = None
-    f = conn.makefile("r", encoding="utf-8", newline="\n")
+    # only the bytes that just arrived can hold a new line end
+    nl = rbuf.find(b"\n", rpos, end)
+    if nl < 0:
+        state["rpos"] = end
+        return
 
+    start = 0
     try:
-        send_line(conn, "[SERVER] Welcome! Enter your username:")
-        username = f.readline().strip()
+        with memoryview(rbuf) as view:
+            while nl >= 0:
+                # one allocation per line, none per recv
+                line = view[start:nl].tobytes()
+                start = nl + 1
+                if not handle_line(conn, state, line):
+                    close_client(conn, state)
+                    return
+                nl = rbuf.find(b"\n", start, end)
+
+            # move the unfinished tail to the front of the buffer
+            view[:end - start] = view[start:end]
+    except Exception:
+        # keep it simple for students
+        close_client(conn, state)
+        return
 
-        if not username:
-            send_line(conn, "[SERVER] Empty username. Bye.")
-            return
+    state["rpos"] = end - start
+    if len(rbuf) > RECV_BUF_SIZE and state["rpos"] <= RECV_BUF_SIZE:
+        # shrink back after a long line has been handled
+        del rbuf[RECV_BUF_SIZE:]
 
-        with clients_lock:
-            if username in clients:
-                send_line(conn, "[SERVER] Username already taken. Bye.")
-                return
-            clients[username] = conn
 
-        send_line(conn, f"[SERVER] Hello {username}!")
-        send_line(conn, "[SERVER] Commands:")
-        send_line(conn, "  /users                -> list online users")
-        send_line(conn, "  /chat <username>      -> start chat with user")
-        send_line(conn, "  /leave                -> leave current chat")
-        send_line(conn, "  /quit                 -> disconnect")
-        send_line(conn, "[SERVER] Tip: after /chat, just type messages normally.")
+def write_ready(conn: socket.socket, state: dict) -> None:
+    flush(conn, state)
 
-        while True:
-            line = f.readline()
-            if not line:
-                # client disconnected
-                break
-
-            msg = line.rstrip("\n")
-
-            if not msg:
-                continue
-
-            if msg.startswith("/"):
-                parts = msg.split(maxsplit=1)
-                cmd = parts[0].lower()
-
-                if cmd == "/users":
-                    users = list_users(username)
-                    if users:
-                        send_line(conn, "[SERVER] Online: " + ", ".join(users))
-                    else:
-                        send_line(conn, "[SERVER] No other users online.")
-
-                elif cmd == "/chat":
-                    if len(parts) < 2 or not parts[1].strip():
-                        send_line(conn, "[SERVER] Usage: /chat <username>")
-                        continue
-
-                    target = parts[1].strip()
-                    if target == username:
-                        send_line(conn, "[SERVER] You can't chat with yourself.")
-                        continue
-
-                    target_sock = get_socket(target)
-                    if not target_sock:
-                        send_line(conn, f"[SERVER] User '{target}' not found.")
-                        continue
-
-                    # Close previous chat if exists
-                    old_partner = get_partner(username)
-                    if old_partner:
-                        with clients_lock:
-                            if pairs.get(old_partner) == username:
-                                pairs.pop(old_partner, None)
-                            pairs.pop(username, None)
-
-                        old_partner_sock = get_socket(old_partner)
-                        if old_partner_sock:
-                            send_line(old_partner_sock, f"[SERVER] {username} left the chat.")
-                        send_line(conn, f"[SERVER] Left previous chat with {old_partner}.")
-
-                    # If target is already in chat, we can choose to refuse
-                    target_partner = get_partner(target)
-                    if target_partner and target_partner != username:
-                        send_line(conn, f"[SERVER] '{target}' is already chatting with '{target_partner}'.")
-                        continue
-
-                    set_pair(username, target)
-                    send_line(conn, f"[SERVER] Chat started with {target}.")
-                    send_line(target_sock, f"[SERVER] {username} started a chat with you. You are now connected.")
-
-                elif cmd == "/leave":
-                    partner = get_partner(username)
-                    if not partner:
-                        send_line(conn, "[SERVER] You're not in a chat.")
-                        continue
-
-                    with clients_lock:
-                        if pairs.get(partner) == username:
-                            pairs.pop(partner, None)
-                        pairs.pop(username, None)
-
-                    partner_sock = get_socket(partner)
-                    if partner_sock:
-                        send_line(partner_sock, f"[SERVER] {username} left the chat.")
-                    send_line(conn, f"[SERVER] You left the chat with {partner}.")
-
-                elif cmd == "/quit":
-                    send_line(conn, "[SERVER] Bye.")
-                    break
-
-                else:
-                    send_line(conn, "[SERVER] Unknown command.")
-                continue
-
-            # normal message -> forward to partner (if exists)
-            partner = get_partner(username)
-            if not partner:
-                send_line(conn, "[SERVER] You're not in a chat. Use /users then /chat <username>.")
-                continue
-
-            partner_sock = get_socket(partner)
-            if not partner_sock:
-                # partner disappeared
-                with clients_lock:
-                    pairs.pop(username, None)
-                send_line(conn, "[SERVER] Partner disconnected. Chat closed.")
-                continue
-
-            send_line(partner_sock, f"{username}: {msg}")
 
-    except Exception:
-        # keep it simple for students
-        pass
-    finally:
-        if username:
-            cleanup_user(username)
-        else:
-            safe_close(conn)
+def accept(s: socket.socket) -> None:
+    """Accept every connection waiting in the backlog, not just one per wakeup."""
+    while True:
         try:
-            f.close()
-        except Exception:
-            pass
+            conn, addr = s.accept()
+        except BlockingIOError:
+            return
+        except ConnectionAbortedError:
+            # the client gave up while still in the backlog, take the next one
+            continue
+        except OSError as e:
+            # e.g. EMFILE/ENFILE: keep serving the clients we already have, and stop
+            # polling the listener for a while, it stays readable and would spin
+            log.warning("accept() failed: %s", e)
+            sel.unregister(s)
+            paused[s] = time.monotonic() + ACCEPT_RETRY_DELAY
+            return
+        # off by default: per-accept output would cost a write + flush under load
+        log.debug("New connection from %s", addr)
+        conn.setblocking(False)
+
+        # the selector map also holds the listening socket
+        if len(sel.get_map()) > MAX_CONNECTIONS:
+            try:
+                conn.send(_BUSY)
+            except Exception:
+                pass
+            safe_close(conn)
+            continue
+
+        # "rbuf" is filled in place by recv_into(), and "out" is a bytearray so
+        # appends grow in place; bytes += bytes would copy the whole buffer
+        # on every chunk and go quadratic on long lines
+        state = {
+            "rbuf": bytearray(RECV_BUF_SIZE),
+            "rpos": 0,
+            "skip": False,
+            "out": bytearray(),
+            "overflow": False,
+            "username": None,
+            "prefix": b"",
+        }
+        sel.register(conn, selectors.EVENT_READ, state)
+        send_bytes(conn, _WELCOME)
+
+
+def resume_listeners() -> None:
+    """Put listeners paused by a failed accept() back once their delay is over."""
+    now = time.monotonic()
+    for s, retry_at in list(paused.items()):
+        if now >= retry_at:
+            del paused[s]
+            sel.register(s, selectors.EVENT_READ, None)
 
 
 def main() -> None:
-    print(f"Server starting on {HOST}:{PORT} ...")
+    logging.basicConfig(level=logging.INFO, format="%(message)s", stream=sys.stdout)
+    log.info("Server starting on %s:%s ...", HOST, PORT)
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    tune_socket(s)
     s.bind((HOST, PORT))
-    s.listen(20)
+    s.listen(socket.SOMAXCONN)
+    s.setblocking(False)
+    # the listener is the only registration without per-connection state
+    sel.register(s, selectors.EVENT_READ, None)
 
     try:
         while True:
-            conn, addr = s.accept()
-            print(f"New connection from {addr}")
-            t = threading.Thread(target=handle_client, args=(conn, addr), daemon=True)
-            t.start()
+            for key, mask in sel.select(ACCEPT_RETRY_DELAY if paused else None):
+                if key.data is None:
+                    accept(key.fileobj)
+                    continue
+                # write first: a failed read may close and unregister the socket
+                if mask & selectors.EVENT_WRITE:
+                    write_ready(key.fileobj, key.data)
+                if mask & selectors.EVENT_READ:
+                    read_ready(key.fileobj, key.data)
+            # one send per socket per iteration, however many lines were queued
+            flush_all()
+            if paused:
+                resume_listeners()
     except KeyboardInterrupt:
-        print("\nServer shutting down.")
+        log.info("\nServer shutting down.")
     finally:
+        sel.close()
         s.close()
 
 
 if __name__ == "__main__":
     main()
-